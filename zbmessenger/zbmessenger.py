@@ -2,216 +2,265 @@
 
 
 from argparse import ArgumentParser
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+import tracemalloc
+import asyncio
 import subprocess
+import cProfile
+import threading
+import hashlib
 import logging
 import logging.handlers
 import operator
+import random
+import fcntl
+import bisect
+import json
+import time
+import os
 import sys
 import re
 
 
+class _Decoded:
+    """
+    Defers decoding a bytes buffer until a log record is actually formatted.
+    """
+    __slots__ = ('_content',)
+
+    def __init__(self, content):
+        self._content = content
+
+    def __str__(self):
+        return bytes(self._content).decode('utf-8', 'replace')
+
+
 class BaculaEmailParser:
+    # Specialised parsers shared by every instance, keyed on the report
+    # layout fingerprint. Least recently used layouts are evicted first.
+    _parsers = OrderedDict()
+    _cache_size = 16
+    # The first matched value of these fields (the name or the level) repeats
+    # across reports. It is shared through a table so each repeated value is
+    # stored once, and the bytes path skips decoding it again. The table
+    # stops growing once full. A private table is used instead of
+    # sys.intern, the converters compare some values by identity.
+    _strings = {}
+    _strings_size = 4096
+    _string_hits = 0
+    _string_misses = 0
+    _shared_keys = frozenset([
+        "backup_level",
+        "client",
+        "file_set",
+        "pool",
+        "catalog",
+        "storage",
+        "fd_term",
+        "sd_term",
+        "termination"
+    ])
 
     def __init__(self):
         """
         Parses the information from the bacula job using regular expression.
+        Bacula and Bareos versions differ in which lines a job report contains,
+        so the layout of each report (the labels found and their order) is
+        fingerprinted and a single pass parser is compiled for that layout.
         """
         self._logger = logging.getLogger('zbmessenger.BaculaEmailParser')
         # Default content applicable to all bacula information lines.
         self._defaults = ['^[^\S\n]*', '[^\S\n]*', '$']
-        # List of all the regular expressions for each line in bacula job report
+        # Label and value regular expression for each line in bacula job report.
+        # All the lines are matched by a single expression, so a value must
+        # never match across a newline or it swallows the following lines.
         self._bacula = {
-            "job_id": '{0}JobId:{1}(\d+){2}'.format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "job": "{0}Job:{1}(.[^\.]+)\.(.[^_]+)\_(.[^\_]+)\_(.+){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "backup_level": "{0}Backup Level:{1}(.[^,]+)(?:, since=)?(\d\d\d\d-\d\d-\d\d)?[ ]?(\d\d:\d\d:\d\d)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "client": "{0}Client:{1}\"(.+)\"[ ]?(.+)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "file_set": "{0}FileSet:{1}\"(.+)\"[ ]?(\d\d\d\d-\d\d-\d\d)?[ ]?(\d\d:\d\d:\d\d)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "pool": "{0}Pool:{1}\"(.+)\"[ ]?(.+)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "catalog": "{0}Catalog:{1}\"(.+)\"[ ]?(.+)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "storage": "{0}Storage:{1}\"(.+)\"[ ]?(.+)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "scheduled_time": "{0}Scheduled time:{1}(\d\d-[a-zA-Z]{{3,4}}-\d\d\d\d \d\d:\d\d:\d\d){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "start_time": "{0}Start time:{1}(\d\d-[a-zA-Z]{{3,4}}-\d\d\d\d \d\d:\d\d:\d\d){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "end_time": "{0}End time:{1}(\d\d-[a-zA-Z]{{3,4}}-\d\d\d\d \d\d:\d\d:\d\d){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "elapsed_time": "{0}Elapsed time:{1}(\d*)[ ]?([a-zA-Z]*)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "priority": "{0}Priority:{1}([-]?\d*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "fd_files_written": "{0}FD Files Written:{1}([0-9,]*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "sd_files_written": "{0}SD Files Written:{1}([0-9,]*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "fd_bytes_written": "{0}FD Bytes Written:{1}([\d,]*).*{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "sd_bytes_written": "{0}SD Bytes Written:{1}([\d,]*).*{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "rate": "{0}Rate:{1}([0-9.,]*)[ ]?(.*)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "sw_compression": "{0}Software Compression:{1}([\d]*[\.[\d]*]?)?(?:[\%])?(?:[ ])?(?:([\d.]*)\:([\d]*))?(None)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "cl_compression": "{0}Comm Line Compression:{1}([\d]*[\.[\d]*]?)?(?:[\%])?(?:[ ])?(?:([\d.]*)\:([\d]*))?(None)?{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "snapshot": "{0}Snapshot/VSS:{1}(no|yes){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "encryption": "{0}Encryption:{1}(no|yes){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "accurate": "{0}Accurate:{1}(no|yes){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "volume_name": "{0}Volume name\(s\):{1}(.*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "volume_session_id": "{0}Volume Session Id:{1}(\d*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "volume_session_time": "{0}Volume Session Time:{1}(\d*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "lvbytes": "{0}Last Volume Bytes:{1}([0-9,]*).*{2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "fd_errors": "{0}Non-fatal FD errors:{1}(\d*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "sd_errors": "{0}SD Errors:{1}(\d*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "fd_term": "{0}FD termination status:{1}(.*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "sd_term": "{0}SD termination status:{1}(.*){2}".format(
-                self._defaults[0],
-                self._defaults[1],
-                self._defaults[2]
-            ),
-            "termination": "{0}Termination:{1}(.*){2}".format(
-                self._defaults[0],
+            "job_id": ("JobId", r'(\d+)'),
+            "job": ("Job", r'(.[^.\n]+)\.(.[^_\n]+)\_(.[^_\n]+)\_(.+)'),
+            "backup_level": ("Backup Level", r'(.[^,\n]+)(?:, since=)?(\d\d\d\d-\d\d-\d\d)?[ ]?(\d\d:\d\d:\d\d)?'),
+            "client": ("Client", r'"(.+)"[ ]?(.+)?'),
+            "file_set": ("FileSet", r'"(.+)"[ ]?(\d\d\d\d-\d\d-\d\d)?[ ]?(\d\d:\d\d:\d\d)?'),
+            "pool": ("Pool", r'"(.+)"[ ]?(.+)?'),
+            "catalog": ("Catalog", r'"(.+)"[ ]?(.+)?'),
+            "storage": ("Storage", r'"(.+)"[ ]?(.+)?'),
+            "scheduled_time": ("Scheduled time", r'(\d\d-[a-zA-Z]{3,4}-\d\d\d\d \d\d:\d\d:\d\d)'),
+            "start_time": ("Start time", r'(\d\d-[a-zA-Z]{3,4}-\d\d\d\d \d\d:\d\d:\d\d)'),
+            "end_time": ("End time", r'(\d\d-[a-zA-Z]{3,4}-\d\d\d\d \d\d:\d\d:\d\d)'),
+            "elapsed_time": ("Elapsed time", r'(\d*)[ ]?([a-zA-Z]*)?'),
+            "priority": ("Priority", r'([-]?\d*)'),
+            "fd_files_written": ("FD Files Written", r'([0-9,]*)'),
+            "sd_files_written": ("SD Files Written", r'([0-9,]*)'),
+            "fd_bytes_written": ("FD Bytes Written", r'([\d,]*).*'),
+            "sd_bytes_written": ("SD Bytes Written", r'([\d,]*).*'),
+            "rate": ("Rate", r'([0-9.,]*)[ ]?(.*)?'),
+            "sw_compression": ("Software Compression", r'([\d]*[\.[\d]*]?)?(?:[\%])?(?:[ ])?(?:([\d.]*)\:([\d]*))?(None)?'),
+            "cl_compression": ("Comm Line Compression", r'([\d]*[\.[\d]*]?)?(?:[\%])?(?:[ ])?(?:([\d.]*)\:([\d]*))?(None)?'),
+            "snapshot": ("Snapshot/VSS", r'(no|yes)'),
+            "encryption": ("Encryption", r'(no|yes)'),
+            "accurate": ("Accurate", r'(no|yes)'),
+            "volume_name": ("Volume name(s)", r'(.*)'),
+            "volume_session_id": ("Volume Session Id", r'(\d*)'),
+            "volume_session_time": ("Volume Session Time", r'(\d*)'),
+            "lvbytes": ("Last Volume Bytes", r'([0-9,]*).*'),
+            "fd_errors": ("Non-fatal FD errors", r'(\d*)'),
+            "sd_errors": ("SD Errors", r'(\d*)'),
+            "fd_term": ("FD termination status", r'(.*)'),
+            "sd_term": ("SD termination status", r'(.*)'),
+            "termination": ("Termination", r'(.*)')
+        }
+        # Map each label to its key, including labels renamed by other
+        # versions (copy/migration jobs report the pool and storage written to).
+        self._labels = {label: key for key, (label, _) in self._bacula.items()}
+        self._labels.update({
+            "Write Pool": "pool",
+            "Write Storage": "storage"
+        })
+        # Matches the label at the start of every "Label: value" line.
+        self._label_pattern = re.compile(
+            '{0}([^:\n]+):'.format(self._defaults[0]), re.MULTILINE)
+        self._label_pattern_bytes = re.compile(
+            self._label_pattern.pattern.encode('ascii'), re.MULTILINE)
+
+    def _fingerprint(self, content):
+        """
+        Returns the known labels of the report in the order they appear.
+        """
+        binary = not isinstance(content, str)
+        pattern = self._label_pattern_bytes if binary else self._label_pattern
+        fingerprint = []
+        for match in pattern.finditer(content):
+            label = match.group(1)
+            if binary:
+                label = label.decode('ascii', 'replace')
+            if label in self._labels and label not in fingerprint:
+                fingerprint.append(label)
+        return tuple(fingerprint)
+
+    def _compile(self, fingerprint, binary=False):
+        """
+        Builds a single regular expression matching every line of the layout,
+        with one named alternative per label. Returns the expression and,
+        for each alternative, the key and the index range of its groups.
+        A bytes expression is built when binary is set.
+        """
+        alternatives = []
+        groups = {}
+        offset = 1
+        for index, label in enumerate(fingerprint):
+            key = self._labels[label]
+            value = self._bacula[key][1]
+            name = 'f{0}'.format(index)
+            alternatives.append('(?P<{0}>{1}:{2}{3}{4})'.format(
+                name,
+                re.escape(label),
                 self._defaults[1],
+                value,
                 self._defaults[2]
-            )
+            ))
+            count = re.compile(value).groups
+            groups[name] = (key, offset + 1, offset + 1 + count)
+            offset += 1 + count
+        pattern = '{0}(?:{1})'.format(self._defaults[0], '|'.join(alternatives))
+        if binary:
+            pattern = pattern.encode('ascii')
+        return re.compile(pattern, re.MULTILINE), groups
+
+    def _parser(self, fingerprint, binary=False):
+        """
+        Returns the specialised parser for the layout, compiling it on a miss.
+        """
+        parsers = BaculaEmailParser._parsers
+        parser = parsers.get((fingerprint, binary))
+        if parser is not None:
+            parsers.move_to_end((fingerprint, binary))
+            return parser
+        self._logger.debug("Compiling parser for layout %s", fingerprint)
+        parser = self._compile(fingerprint, binary)
+        parsers[(fingerprint, binary)] = parser
+        if len(parsers) > BaculaEmailParser._cache_size:
+            parsers.popitem(last=False)
+        return parser
+
+    def _share(self, value, binary=False):
+        """
+        Returns the shared string for the matched value, adding it to the
+        table on a miss. Bytes values are decoded on a miss only.
+        """
+        strings = BaculaEmailParser._strings
+        shared = strings.get(value)
+        if shared is not None:
+            BaculaEmailParser._string_hits += 1
+            return shared
+        BaculaEmailParser._string_misses += 1
+        shared = value.decode('utf-8', 'replace') if binary else value
+        if len(strings) < BaculaEmailParser._strings_size:
+            strings[value] = shared
+        return shared
+
+    @classmethod
+    def shared_info(cls):
+        """
+        Returns the hits, misses and size of the shared string table.
+        """
+        return {
+            'hits': cls._string_hits,
+            'misses': cls._string_misses,
+            'size': len(cls._strings)
         }
 
     def parse_email(self, content):
         """
         Parses the email, extracts the relevant data that will be forward to the
-        Zabbix Server
-        """
-        self._logger.info(content)
-        parameters = {}
-        for key, value in self._bacula.items():
-            items = list()
-            for y in re.findall(value, content, re.MULTILINE):
-                # Instead of lists of tuples, flatten the list.
-                # Discard any empty strings
-                if isinstance(y, tuple):
-                    for z in y:
-                        if z is not '' and z.isspace() is False:
-                            items.append(z)
+        Zabbix Server.
+        The content can also be a bytes-like object (e.g. a memoryview over
+        the raw email), only the matched fields are then decoded.
+        """
+        binary = not isinstance(content, str)
+        if binary:
+            # Decoding the whole email would defeat the bytes path, the email
+            # is only decoded when the log file is at debug level.
+            self._logger.info("Parsing email of %d bytes.", len(content))
+            self._logger.debug("%s", _Decoded(content))
+        else:
+            self._logger.info(content)
+        parameters = {key: None for key in self._bacula}
+        fingerprint = self._fingerprint(content)
+        if len(fingerprint) == 0:
+            self._logger.warning("No known Bacula lines found in the email.")
+            return parameters
+        pattern, groups = self._parser(fingerprint, binary)
+        for match in pattern.finditer(content):
+            key, first, last = groups[match.lastgroup]
+            # Flatten the groups of each line, discard any empty strings
+            items = [z for z in map(match.group, range(first, last))
+                     if z and z.isspace() is False]
+            start = 0
+            if key in self._shared_keys and len(items) > 0:
+                items[0] = self._share(items[0], binary)
+                start = 1
+            if binary:
+                items[start:] = [z.decode('utf-8', 'replace')
+                                 for z in items[start:]]
+            if len(items) > 0:
+                if parameters[key] is None:
+                    parameters[key] = items
                 else:
-                    if y is not '' and y.isspace() is False:
-                        items.append(y)
-            if len(items) == 0:
-                items = None
-            parameters[key] = items
+                    parameters[key].extend(items)
+        for key, value in parameters.items():
             self._logger.info("Key:%s - Value : %s", key, value)
         return parameters
 
 
 class ZabbixSender:
     # Uses SubPorcess to generate a shell and send parsed Bacula data to Zabbix
+    # zabbix_sender exit codes: 0 all values processed, 2 values sent but some
+    # failed processing on the server, 1 sending failed.
+    PROCESSED = 0
+    SEND_FAILED = 1
+    PARTIALLY_PROCESSED = 2
+
     def __init__(self, zabbix_sender_binaries):
         """
         Responsible for taking the data parsed by Baculaemail_parser and
@@ -224,39 +273,114 @@ class ZabbixSender:
         self._binaries = zabbix_sender_binaries
         pass
 
-    def send(self, zabbix_server, client, values, debug_send=False):
+    def _command(self, zabbix_server, client):
         # -z is the ip/hostname for the zabbix server
         # -s is the name of the host as specified in Zabbix (i.e the server that you want the values connected to)
         # -i and - tells zabbix_sender to wait for values to be piped in.
-        command = [self._binaries,
-                   '-z',
-                   zabbix_server,
-                   '-s',
-                   client,
-                   '-i',
-                   '-'
-                   ]
+        return [self._binaries,
+                '-z',
+                zabbix_server,
+                '-s',
+                client,
+                '-i',
+                '-'
+                ]
+
+    def send(self, zabbix_server, client, values, debug_send=False):
+        command = self._command(zabbix_server, client)
         # Used for debugging purposes.
         # Easier to spot which value Zabbix failed
         if debug_send:
             return_code = True
-            for line in values.split('\n'):
+            separator = '\n' if isinstance(values, str) else b'\n'
+            for line in values.split(separator):
                 self._logger.debug("Executing command %s < %s", command, line)
                 return_code &= self._execute(command, line)
             return return_code
         else:
             return self._execute(command, values)
 
+    def deliver(self, zabbix_server, client, values):
+        """
+        Sends the values in a single zabbix_sender run and returns its exit code.
+        """
+        command = self._command(zabbix_server, client)
+        self._logger.debug("Executing command %s < %s", command, values)
+        return self._run(command, values)
+
     def _execute(self, command, values):
         """
         Launches a process and executes the command
         """
+        return self._run(command, values) == self.PROCESSED
+
+    def _run(self, command, values):
+        """
+        Launches a process, executes the command and returns the exit code.
+        """
         process = subprocess.Popen(command,
                                    stdout=subprocess.PIPE,
                                    stdin=subprocess.PIPE,
                                    stderr=subprocess.STDOUT)
         # Pipe in the values in binary format.
-        stdout = process.communicate(input=values.encode())
+        if isinstance(values, str):
+            values = values.encode()
+        stdout = process.communicate(input=values)
+        self._logger.debug(stdout)
+        return_code = process.returncode
+        if return_code != 0:
+            self._logger.warning(stdout)
+        return return_code
+
+
+class AsyncZabbixSender(ZabbixSender):
+    def __init__(self, zabbix_sender_binaries):
+        """
+        Asynchronous version of ZabbixSender, the zabbix_sender process is
+        run with asyncio so other work can proceed while it is sending.
+        """
+        super().__init__(zabbix_sender_binaries)
+        self._logger = logging.getLogger('zbmessenger.AsyncZabbixSender')
+
+    async def send(self, zabbix_server, client, values, debug_send=False):
+        command = self._command(zabbix_server, client)
+        if debug_send:
+            return_code = True
+            separator = '\n' if isinstance(values, str) else b'\n'
+            for line in values.split(separator):
+                self._logger.debug("Executing command %s < %s", command, line)
+                return_code &= await self._execute(command, line)
+            return return_code
+        else:
+            return await self._execute(command, values)
+
+    async def _execute(self, command, values):
+        """
+        Launches a process and executes the command
+        """
+        spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+            *command,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.STDOUT))
+        # Pipe in the values in binary format.
+        if isinstance(values, str):
+            values = values.encode()
+        try:
+            # Cancelling while the process is being created can leave asyncio
+            # waiting on pipes that never connect, so the creation is shielded.
+            process = await asyncio.shield(spawn)
+            stdout = await process.communicate(input=values)
+        except asyncio.CancelledError:
+            # Don't leave the zabbix_sender process behind.
+            process = await spawn
+            if process.returncode is None:
+                process.kill()
+            # The process only counts as finished once its pipes are closed.
+            if process.stdin is not None:
+                process.stdin.close()
+            await process.wait()
+            raise
         self._logger.debug(stdout)
         return_code = process.returncode
         if return_code != 0:
@@ -264,6 +388,222 @@ class ZabbixSender:
         return return_code == 0
 
 
+class AsyncPipeline:
+    def __init__(self, prepare, send, queue_size=8, workers=1):
+        """
+        Overlaps parsing with sending. prepare(report, buffer) reads, parses
+        and formats an email and returns (client, values), it runs in the
+        default executor. send(client, values) is a coroutine sending them. A report that fails to be read or parsed
+        is only marked as not sent, the other reports are still processed.
+        Prepared emails wait in a bounded queue, once queue_size emails are
+        waiting the parsing pauses until a worker has finished sending.
+        Output buffers are recycled once sent, at most
+        queue_size + workers + 1 of them exist at any time.
+        """
+        self._logger = logging.getLogger('zbmessenger.AsyncPipeline')
+        self._prepare = prepare
+        self._send = send
+        self._queue_size = max(queue_size or 1, 1)
+        self._workers = max(workers or 1, 1)
+        self._buffers = []
+
+    async def _produce(self, reports, queue, results):
+        loop = asyncio.get_event_loop()
+        for index, report in enumerate(reports):
+            results.append(False)
+            buffer = self._buffers.pop() if self._buffers else bytearray()
+            try:
+                # Reading, parsing and the volume index lock would block the
+                # sends in flight, prepare runs in a thread. Reports are still
+                # prepared one at a time.
+                client, values = await loop.run_in_executor(
+                    None, self._prepare, report, buffer)
+            except Exception as e:
+                self._logger.exception("Unable to prepare report %s", report)
+                self._buffers.append(buffer)
+                continue
+            await queue.put((index, client, values, buffer))
+        for _ in range(self._workers):
+            await queue.put(None)
+
+    async def _consume(self, queue, results):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, client, values, buffer = item
+            try:
+                results[index] = await self._send(client, values)
+            except Exception as e:
+                self._logger.exception("Unable to send report %d", index)
+            self._buffers.append(buffer)
+
+    async def _run(self, reports):
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        results = []
+        consumers = [asyncio.ensure_future(self._consume(queue, results))
+                     for _ in range(self._workers)]
+        try:
+            await self._produce(reports, queue, results)
+            await asyncio.gather(*consumers)
+        except BaseException:
+            # Stop the sends in flight before the loop is closed.
+            for consumer in consumers:
+                consumer.cancel()
+            await asyncio.gather(*consumers, return_exceptions=True)
+            raise
+        return results
+
+    def run(self, reports):
+        """
+        Processes every report, returns whether each was sent.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            return loop.run_until_complete(self._run(reports))
+        finally:
+            if hasattr(loop, 'shutdown_default_executor'):
+                loop.run_until_complete(loop.shutdown_default_executor())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class ZabbixShardedSender:
+    def __init__(self, sender, zabbix_servers, retry_interval=300,
+                 health_file=None, replicas=64):
+        """
+        Spreads the Bacula clients across several Zabbix servers/proxies.
+        Each client is mapped to a server with consistent hashing, so adding
+        or removing a server only moves the clients of that server. When
+        sending to a server fails, the next server on the ring is used and
+        the failed one is skipped for retry_interval seconds. Values that
+        reached a server but failed processing are not sent again.
+        The health state can be kept in health_file so it survives across the
+        processes started by Postfix, the file is locked while it is updated.
+        Concurrent sends to the shards come from the --reports pipeline workers.
+        """
+        self._logger = logging.getLogger('zbmessenger.ZabbixShardedSender')
+        self._sender = sender
+        self._servers = list(zabbix_servers)
+        self._retry_interval = retry_interval
+        self._health_file = health_file
+        self._lock = threading.Lock()
+        # Each server is placed on the ring several times to even out the load.
+        self._ring = sorted(
+            (self._hash('%s-%d' % (server, replica)), server)
+            for server in self._servers
+            for replica in range(replicas))
+        self._keys = [key for key, _ in self._ring]
+        # Server -> time until which the server is considered down.
+        self._health = self._load_health()
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+    @staticmethod
+    def _read_health(health_file):
+        health_file.seek(0)
+        content = health_file.read()
+        return json.loads(content) if content.strip() != '' else {}
+
+    def _load_health(self):
+        if self._health_file is None:
+            return {}
+        try:
+            with open(self._health_file) as health_file:
+                fcntl.flock(health_file, fcntl.LOCK_SH)
+                health = self._read_health(health_file)
+            return {server: float(until) for server, until in health.items()
+                    if server in self._servers}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self._logger.warning(
+                "Unable to read the health file %s.", self._health_file)
+            return {}
+
+    def _save_health(self, server, until):
+        """
+        Updates the server in the health file, keeping the changes made by
+        other processes to the other servers.
+        """
+        if self._health_file is None:
+            return
+        try:
+            with open(self._health_file, 'a+') as health_file:
+                fcntl.flock(health_file, fcntl.LOCK_EX)
+                health = self._read_health(health_file)
+                if until is None:
+                    health.pop(server, None)
+                else:
+                    health[server] = until
+                health_file.seek(0)
+                health_file.truncate()
+                json.dump(health, health_file)
+        except Exception as e:
+            self._logger.warning(
+                "Unable to write the health file %s.", self._health_file)
+
+    def _mark(self, server, healthy):
+        with self._lock:
+            if healthy:
+                if self._health.pop(server, None) is not None:
+                    self._save_health(server, None)
+            else:
+                until = time.time() + self._retry_interval
+                self._health[server] = until
+                self._save_health(server, until)
+
+    def servers(self, client):
+        """
+        Returns the servers in ring order starting at the client's server.
+        Servers marked as down are moved to the end, so they are only
+        tried when every other server failed.
+        """
+        start = bisect.bisect(self._keys, self._hash(client))
+        ordered = []
+        for index in range(len(self._ring)):
+            server = self._ring[(start + index) % len(self._ring)][1]
+            if server not in ordered:
+                ordered.append(server)
+        now = time.time()
+        with self._lock:
+            down = [server for server in ordered
+                    if self._health.get(server, 0) > now]
+        return [server for server in ordered if server not in down] + down
+
+    def send(self, client, values, debug_send=False):
+        """
+        Sends the values to the client's server, failing over to the next
+        server on the ring when zabbix_sender could not send them.
+        With debug_send each line is sent individually, only the lines not
+        yet sent are passed on to the next server.
+        """
+        if debug_send:
+            separator = '\n' if isinstance(values, str) else b'\n'
+            pending = values.split(separator)
+        else:
+            pending = [values]
+        processed = True
+        for server in self.servers(client):
+            while len(pending) > 0:
+                return_code = self._sender.deliver(server, client, pending[0])
+                if return_code == ZabbixSender.SEND_FAILED:
+                    break
+                processed &= return_code == ZabbixSender.PROCESSED
+                pending.pop(0)
+            if len(pending) == 0:
+                self._mark(server, True)
+                return processed
+            self._logger.warning(
+                "Unable to send data for %s to %s, trying next server.",
+                client, server)
+            self._mark(server, False)
+        return False
+
+
 class ZabbixParameters:
     def __init__(self):
         self._logger = logging.getLogger('zbmessenger.ZabbixParameters')
@@ -316,6 +656,8 @@ class ZabbixParameters:
             "sd_term": self.sd_term,
             "termination": self.termination
         }
+        # Encoded "- bacula.<key> " line prefixes used by write_parameters.
+        self._prefixes = {}
         self.values = {}
     # All methods below, takes the values from the regular exception and
     # and returns a value that is then sent to the zabbix sender.
@@ -685,9 +1027,270 @@ class ZabbixParameters:
         """
         return "\n".join(['%s bacula.%s %s' % ('-', key, value) for (key, value) in values.items() if key is not 'client'])
 
+    def write_parameters(self, values, buffer):
+        """
+        Same output as parameters, but written as bytes into the supplied
+        bytearray, which is cleared first so it can be reused across messages.
+        Numbers are written directly without building an intermediate string.
+        """
+        del buffer[:]
+        for key, value in values.items():
+            if key == 'client':
+                continue
+            prefix = self._prefixes.get(key)
+            if prefix is None:
+                prefix = self._prefixes[key] = ('- bacula.%s ' % key).encode()
+            if len(buffer) > 0:
+                buffer += b'\n'
+            buffer += prefix
+            if isinstance(value, int):
+                buffer += b'%d' % value
+            elif isinstance(value, str):
+                buffer += value.encode()
+            else:
+                buffer += str(value).encode()
+        return buffer
+
+
+class VolumeIndex:
+    def __init__(self, index_file):
+        """
+        Keeps a local index of the volumes written by the Bacula jobs, so
+        volume fill rates can be monitored without querying the catalog.
+        For each volume the index holds the bytes of the jobs written
+        entirely to that volume, the number of jobs, the time it was last
+        written to, the clients that wrote to it and, for the last volume of
+        a job, the Last Volume Bytes reported by Bacula.
+        The index is a JSON file, locked while it is updated since Postfix
+        may run several instances of the script at the same time.
+        """
+        self._logger = logging.getLogger('zbmessenger.VolumeIndex')
+        self._index_file = index_file
+        # Number of job ids remembered per volume to detect repeated reports.
+        self._recent_jobs = 50
+
+    def volumes(self, volume_name):
+        """
+        Splits the "Volume name(s)" value, volumes are separated by '|'.
+        """
+        if volume_name is None:
+            return []
+        return [volume.strip() for volume in volume_name.split('|')
+                if volume.strip() != '']
+
+    def update(self, values):
+        """
+        Adds the job in values (as returned by ZabbixParameters.format) to the
+        index. Returns the low level discovery and the per volume items, both
+        in the zabbix_sender format (None when the job wrote no volumes).
+        Zabbix creates the items of a discovered volume asynchronously, so
+        values sent in the same run would be rejected. The items of a volume
+        new to the client are therefore only sent with its next report, the
+        values being cumulative nothing but the timing is lost.
+        """
+        volumes = self.volumes(values.get('volume_name'))
+        if len(volumes) == 0:
+            return None, None
+        client = values.get('client')
+        job_id = values.get('job_id')
+        end_time = values.get('end_time')
+        last_written = int(end_time.timestamp() if end_time is not None
+                           else time.time())
+        # The report does not break the bytes down per volume, the bytes
+        # are only known for a job written to a single volume.
+        job_bytes = values.get('sd_bytes_written') if len(volumes) == 1 else None
+        undiscovered = []
+        with open(self._index_file, 'a+') as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            index_file.seek(0)
+            content = index_file.read()
+            index = json.loads(content) if content.strip() != '' else {}
+            for position, volume in enumerate(volumes):
+                entry = index.setdefault(volume, {
+                    'bytes': 0,
+                    'jobs': 0,
+                    'last_written': 0
+                })
+                clients = entry.setdefault('clients', [])
+                if client is not None and client not in clients:
+                    clients.append(client)
+                    undiscovered.append(volume)
+                job_ids = entry.setdefault('job_ids', [])
+                last_job_id = entry.pop('last_job_id', None)
+                if last_job_id is not None and last_job_id not in job_ids:
+                    job_ids.append(last_job_id)
+                # The same report sent twice is only counted once.
+                if job_id is not None:
+                    if job_id in job_ids:
+                        continue
+                    job_ids.append(job_id)
+                    del job_ids[:-self._recent_jobs]
+                if job_bytes is not None:
+                    entry['bytes'] += job_bytes
+                entry['jobs'] += 1
+                entry['last_written'] = max(entry['last_written'], last_written)
+                if position == len(volumes) - 1 and values.get('lvbytes') is not None:
+                    entry['last_volume_bytes'] = values.get('lvbytes')
+            index_file.seek(0)
+            index_file.truncate()
+            json.dump(index, index_file)
+        self._logger.debug("Updated volume index for %s", volumes)
+        if len(undiscovered) > 0:
+            self._logger.info(
+                "Volumes %s discovered, their items are sent with the next report.",
+                undiscovered)
+        return self.discovery(client, index), \
+            self.items(volumes, index, undiscovered)
+
+    def discovery(self, client, index):
+        """
+        Low level discovery of every volume the client wrote to, so volumes
+        are not lost when a job writes to other volumes.
+        """
+        volumes = sorted(volume for volume, entry in index.items()
+                         if client in entry.get('clients', []))
+        discovery = json.dumps(
+            {'data': [{'{#VOLUME}': volume} for volume in volumes]},
+            separators=(',', ':'))
+        return '- bacula.volume.discovery %s' % self._quote(discovery)
+
+    def items(self, volumes, index, undiscovered=()):
+        """
+        Per volume items for the volumes written by the job, except the
+        undiscovered ones. The bytes are only sent for a job written to a
+        single volume.
+        """
+        names = ['jobs', 'last_written', 'last_volume_bytes']
+        if len(volumes) == 1:
+            names.insert(0, 'bytes')
+        lines = []
+        for volume in volumes:
+            if volume in undiscovered:
+                continue
+            entry = index[volume]
+            parameter = self._key_parameter(volume)
+            for name in names:
+                if name in entry:
+                    key = 'bacula.volume.%s[%s]' % (name, parameter)
+                    lines.append('- %s %s' % (self._quote(key), entry[name]))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _key_parameter(parameter):
+        """
+        Quotes an item key parameter when it contains special characters.
+        """
+        if any(character in parameter for character in ',]" ') or \
+                parameter.startswith('['):
+            return '"%s"' % parameter.replace('"', '\\"')
+        return parameter
+
+    @staticmethod
+    def _quote(text):
+        """
+        Quotes a key or value for the zabbix_sender input when it contains
+        whitespace or quotes.
+        """
+        if any(character.isspace() or character in '"\\' for character in text):
+            return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+        return text
+
+
+class Profiler:
+    def __init__(self, profile_dir=None, trace_malloc=0, sample_every=1):
+        """
+        Optional profiling of the parse_email, format and send stages.
+        When profile_dir is set, each sampled message runs under cProfile and
+        the statistics are written to a .pstats file in that directory.
+        When trace_malloc is set, the top trace_malloc allocations of each
+        stage are logged using tracemalloc.
+        Only one message out of sample_every is profiled. The count starts at
+        a random offset, so processes handling a single message (i.e. Postfix
+        pipes) are also sampled one time out of sample_every on average.
+        The --reports pipeline overlaps its messages, so it is profiled and
+        sampled as one batch.
+        """
+        self._logger = logging.getLogger('zbmessenger.Profiler')
+        self._profile_dir = profile_dir
+        self._trace_malloc = trace_malloc or 0
+        self._sample_every = max(sample_every or 1, 1)
+        self._count = random.randrange(self._sample_every)
+        self._profile = None
+        self._sampled = False
+
+    def enabled(self):
+        return self._profile_dir is not None or self._trace_malloc > 0
+
+    def start(self):
+        """
+        Starts profiling a message if it is sampled.
+        """
+        self._sampled = False
+        if not self.enabled():
+            return
+        self._count += 1
+        if self._count % self._sample_every != 0:
+            return
+        self._sampled = True
+        if self._trace_malloc > 0:
+            tracemalloc.start()
+        if self._profile_dir is not None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Logs the top allocations made while running the stage.
+        """
+        if not self._sampled or self._trace_malloc == 0:
+            yield
+            return
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            statistics = after.filter_traces(filters).compare_to(
+                before.filter_traces(filters), 'lineno')
+            self._logger.info("Top allocations for stage %s:", name)
+            for statistic in statistics[:self._trace_malloc]:
+                self._logger.info("%s: %s", name, statistic)
+
+    def stop(self):
+        """
+        Stops profiling the message and writes the cProfile statistics.
+        """
+        if not self._sampled:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+            filename = os.path.join(
+                self._profile_dir,
+                'zbmessenger-%s-%d-%d.pstats' % (
+                    datetime.now().strftime('%Y%m%d%H%M%S'),
+                    os.getpid(),
+                    self._count))
+            try:
+                self._profile.dump_stats(filename)
+                self._logger.info("Profile written to %s.", filename)
+            except Exception as e:
+                self._logger.warning(
+                    "Unable to write the profile to %s.", filename)
+            self._profile = None
+        if self._trace_malloc > 0:
+            tracemalloc.stop()
+        self._logger.info("Shared strings: %s", BaculaEmailParser.shared_info())
+        self._sampled = False
+
 
 class Main:
 
+    def __init__(self):
+        # Output buffer reused for every message on the binary path.
+        self._buffer = bytearray()
+
     def _readMessage(self):
         """
         Reads the email content that is piped in by Postfix.
@@ -697,6 +1300,116 @@ class Main:
             content += line
         return content
 
+    def _readMessageBytes(self):
+        """
+        Reads the email content piped in by Postfix as raw bytes in a single
+        read, without decoding it.
+        """
+        return memoryview(sys.stdin.buffer.read())
+
+    def _readReport(self, path, binary=False):
+        """
+        Reads a saved Bacula email, as a memoryview on the binary path.
+        """
+        if binary:
+            with open(path, 'rb') as report:
+                return memoryview(report.read())
+        with open(path) as report:
+            return report.read()
+
+    def _prepare(self, cmds, email_parser, converter, profiler, content, buffer):
+        """
+        Parses and formats one email, returns the client and the payloads to
+        send in order, in the zabbix_sender format. The volume discovery, when
+        there is one, is sent as its own payload so the rejected values of
+        volumes Zabbix has not created yet can't fail the discovery.
+        """
+        # parse the email content.
+        with profiler.stage('parse_email'):
+            parameters = email_parser.parse_email(content)
+        self._logger.info(parameters)
+        with profiler.stage('format'):
+            # format the values for the zabbix server.
+            all_values = converter.format(parameters)
+            discovery, volume_items = None, None
+            if cmds.get('volume_index') is not None:
+                try:
+                    volume_index = VolumeIndex(cmds.get('volume_index'))
+                    discovery, volume_items = volume_index.update(all_values)
+                except Exception as e:
+                    self._logger.exception("Volume Index Exception")
+            # generate string for of all the values in a zabbix_sender format.
+            if cmds.get('binary') is True:
+                zabbix_formatted = converter.write_parameters(
+                    all_values, buffer)
+                if volume_items:
+                    zabbix_formatted += b'\n' + volume_items.encode()
+            else:
+                zabbix_formatted = converter.parameters(all_values)
+                if volume_items:
+                    zabbix_formatted += '\n' + volume_items
+        payloads = [zabbix_formatted]
+        if discovery is not None:
+            payloads.insert(0, discovery)
+        return converter.get_client(all_values), payloads
+
+    def _runPipeline(self, cmds, email_parser, converter, zabbix_servers, profiler):
+        """
+        Sends the saved emails given with --reports, parsing the next email
+        while the previous ones are being sent.
+        The whole batch is profiled as one. The stages of different reports
+        overlap, so the allocations of a send stage can include those of the
+        reports parsed meanwhile.
+        """
+        binary = cmds.get('binary') is True
+        debug_send = cmds.get('debug_send')
+        if len(zabbix_servers) > 1:
+            sharded = ZabbixShardedSender(ZabbixSender(cmds.get('zabbix_binaries')),
+                                          zabbix_servers,
+                                          cmds.get('retry_interval'),
+                                          cmds.get('health_file'))
+
+            async def send(client, payloads):
+                # Failover uses the synchronous sender, run it in a thread.
+                loop = asyncio.get_event_loop()
+                result = True
+                with profiler.stage('send'):
+                    for values in payloads:
+                        result &= await loop.run_in_executor(
+                            None, sharded.send, client, values, debug_send)
+                return result
+        else:
+            sender = AsyncZabbixSender(cmds.get('zabbix_binaries'))
+
+            async def send(client, payloads):
+                result = True
+                with profiler.stage('send'):
+                    for values in payloads:
+                        result &= await sender.send(zabbix_servers[0], client,
+                                                    values, debug_send)
+                return result
+
+        def prepare(path, buffer):
+            content = self._readReport(path, binary)
+            return self._prepare(cmds, email_parser, converter, profiler,
+                                 content, buffer)
+
+        pipeline = AsyncPipeline(prepare, send,
+                                 cmds.get('queue_size'),
+                                 cmds.get('workers'))
+        profiler.start()
+        try:
+            results = pipeline.run(cmds.get('reports'))
+        finally:
+            profiler.stop()
+        self._logger.debug("Shared strings: %s", BaculaEmailParser.shared_info())
+        self._logger.info("%d of %d reports successfully sent to the zabbix server.",
+                          results.count(True), len(results))
+        if results.count(True) != len(results):
+            self._logger.warning(
+                "%d reports were not successfully sent to the zabbix server.",
+                len(results) - results.count(True))
+
     def _setupLogging(self, logfile='/tmp/zbmessenger.log'):
         """
         Configures location and default log level.
@@ -740,10 +1453,25 @@ class Main:
             cmd_parser.add_argument(
                 '--zabbix_server',
                 type=str,
-                help='IP/Hostname to Zabbix Server',
+                help='IP/Hostname to Zabbix Server, or a comma separated list of servers/proxies to shard the clients across.',
                 default=None,
                 required=True,
             )
+            # Health state of the servers when sharding, kept between runs.
+            cmd_parser.add_argument(
+                '--health_file',
+                type=str,
+                help='Location of the file keeping track of unavailable Zabbix servers.',
+                default=None,
+                required=False
+            )
+            cmd_parser.add_argument(
+                '--retry_interval',
+                type=int,
+                help='Seconds before an unavailable Zabbix server is tried again, defaults to 300.',
+                default=300,
+                required=False
+            )
             # Log file level, default to /var/log/zbmessenger.log
             cmd_parser.add_argument(
                 '--logfile',
@@ -758,6 +1486,63 @@ class Main:
                 help="Send each key/value individually to the zabbix server.",
                 action='store_true'
             )
+            cmd_parser.add_argument(
+                '--binary',
+                '-b',
+                help="Parse the email as bytes and pipe the values to zabbix_sender without text decoding.",
+                action='store_true'
+            )
+            # Saved emails sent through the asyncio pipeline instead of stdin.
+            cmd_parser.add_argument(
+                '--reports',
+                type=str,
+                nargs='+',
+                help='Saved Bacula emails to send instead of reading stdin, parsing overlaps with sending.',
+                default=None,
+                required=False
+            )
+            cmd_parser.add_argument(
+                '--queue_size',
+                type=int,
+                help='Number of parsed reports waiting to be sent before parsing pauses, defaults to 8.',
+                default=8,
+                required=False
+            )
+            cmd_parser.add_argument(
+                '--workers',
+                type=int,
+                help='Number of reports sent at the same time with --reports, defaults to 1.',
+                default=1,
+                required=False
+            )
+            cmd_parser.add_argument(
+                '--volume_index',
+                type=str,
+                help='Location of the volume index file, enables the per volume items.',
+                default=None,
+                required=False
+            )
+            cmd_parser.add_argument(
+                '--profile',
+                type=str,
+                help='Directory where a cProfile .pstats file is written for each profiled message.',
+                default=None,
+                required=False
+            )
+            cmd_parser.add_argument(
+                '--trace_malloc',
+                type=int,
+                help='Log the top N tracemalloc allocations of the parse_email, format and send stages.',
+                default=0,
+                required=False
+            )
+            cmd_parser.add_argument(
+                '--profile_every',
+                type=int,
+                help='Profile only one message (one batch with --reports) out of N, defaults to 1 (every message).',
+                default=1,
+                required=False
+            )
 
             try:
                 cmds = vars(cmd_parser.parse_args())
@@ -767,23 +1552,51 @@ class Main:
                     self._fh.setLevel(logging.DEBUG)
                 elif cmds.get('quiet') is True:
                     self._fh.setLevel(logging.WARN)
-                # Read data from Pipe
-                bacula_email = self._readMessage()
+                binary = cmds.get('binary') is True
+                profiler = Profiler(cmds.get('profile'),
+                                    cmds.get('trace_malloc'),
+                                    cmds.get('profile_every'))
                 email_parser = BaculaEmailParser()
-                # parse the email content.
-                parameters = email_parser.parse_email(bacula_email)
-                self._logger.info(parameters)
                 converter = ZabbixParameters()
-                # format the values for the zabbix server.
-                all_values = converter.format(parameters)
-                # generate string for of all the values in a zabbix_sender format.
-                zabbix_formatted = converter.parameters(all_values)
-                sender = ZabbixSender(cmds.get('zabbix_binaries'))
-                # send data to the zabbix server.
-                result = sender.send(cmds.get('zabbix_server'),
-                                     converter.get_client(all_values),
-                                     zabbix_formatted,
-                                     cmds.get('debug_send'))
+                zabbix_servers = [server.strip() for server in
+                                  cmds.get('zabbix_server').split(',')
+                                  if server.strip() != '']
+                if cmds.get('reports') is not None:
+                    self._runPipeline(cmds, email_parser, converter,
+                                      zabbix_servers, profiler)
+                    return
+                # Read data from Pipe
+                if binary:
+                    bacula_email = self._readMessageBytes()
+                else:
+                    bacula_email = self._readMessage()
+                profiler.start()
+                try:
+                    client, payloads = self._prepare(
+                        cmds, email_parser, converter, profiler, bacula_email,
+                        self._buffer)
+                    sender = ZabbixSender(cmds.get('zabbix_binaries'))
+                    if len(zabbix_servers) > 1:
+                        sender = ZabbixShardedSender(sender,
+                                                     zabbix_servers,
+                                                     cmds.get('retry_interval'),
+                                                     cmds.get('health_file'))
+                    # send data to the zabbix server.
+                    result = True
+                    with profiler.stage('send'):
+                        for zabbix_formatted in payloads:
+                            if len(zabbix_servers) > 1:
+                                result &= sender.send(client,
+                                                      zabbix_formatted,
+                                                      cmds.get('debug_send'))
+                            else:
+                                result &= sender.send(zabbix_servers[0],
+                                                      client,
+                                                      zabbix_formatted,
+                                                      cmds.get('debug_send'))
+                finally:
+                    # Also write the profile of a failed run.
+                    profiler.stop()
                 if result is True:
                     self._logger.info(
                         "Data successfully sent to the zabbix server.")